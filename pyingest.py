@@ -2,29 +2,110 @@ import pandas as pd
 from neo4j import GraphDatabase
 import yaml
 import datetime
+import time
 import sys
+import re
+import warnings
 import gzip
 from zipfile import ZipFile
 from urllib.parse import urlparse
 import boto3
+import botocore.config
+import functools
 from smart_open import open
 import io
 import pathlib
-import ijson
+import os
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
+import threading
+import queue
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pa_compute
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 config = dict()
 supported_compression_formats = ['gzip', 'zip', 'none']
+supported_csv_engines = ['pandas', 'pyarrow']
+supported_json_engines = ['ijson', 'orjson']
+csv_block_size = 8 << 20
+# pandas' default na_values, which the pandas path blanks to "".  The pyarrow engine treats the same
+# cells as nulls so both engines produce the same records
+csv_null_values = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+                   '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+read_buffer_size = 16 << 20
+prefetch_block_size = 4 << 20
+gzip_size_ratio = 20
+progress_interval = 1.0
+apoc_batches_per_chunk = 50
+unwind_rows = re.compile(r'^\s*UNWIND\s+\$rows\s+AS\s+row\s+', re.IGNORECASE)
+driver_timeout_params = ['connection_acquisition_timeout', 'max_connection_lifetime', 'connection_timeout']
 
 class LocalServer(object):
 
     def __init__(self):
+        # Chunks are written to Neo4j by a pool of workers, each with its own session, so that
+        # parsing the next chunk overlaps with the Bolt round-trip of the previous ones.  The
+        # default single worker keeps chunks in file order; chunk_workers > 1 gives that up, so
+        # rows may no longer MERGE/MATCH against rows from earlier chunks of the same file
+        self._workers = config.get('chunk_workers') or 1
         self._driver = GraphDatabase.driver(config['server_uri'],
                                             auth=(config['admin_user'],
-                                                  config['admin_pass']))
+                                                  config['admin_pass']),
+                                            **self.get_driver_params())
+        self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
 
     def close(self):
+        self._executor.shutdown(wait=True)
+        for session in self._sessions:
+            session.close()
         self._driver.close()
 
+    # Sessions are not thread safe, so every worker thread lazily opens its own
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._driver.session()
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    # Runs on a worker: turns a DataFrame/Arrow chunk into records and writes them in their own
+    # transaction, retried by the driver on transient errors unless the file uses apoc_parallel
+    def _write_chunk(self, params, chunk):
+        if params['apoc_parallel']:
+            do_apoc_write(self._session(), params['cql'], chunk_records(chunk))
+        else:
+            self._session().execute_write(do_write, params['cql'], chunk_records(chunk))
+
+    # Hand a chunk to the writer pool.  Once too many chunks are in flight, block on the oldest
+    # one so the parser can't run arbitrarily far ahead of Neo4j
+    def _submit_chunk(self, pending, params, chunk):
+        pending.append(self._executor.submit(self._write_chunk, params, chunk))
+        if len(pending) > 2 * self._workers:
+            pending.popleft().result()
+
+    @staticmethod
+    def _wait_chunks(pending):
+        while pending:
+            pending.popleft().result()
+
     def load_file(self, file):
 
         # Set up parameters/defaults
@@ -54,48 +135,65 @@ class LocalServer(object):
 
         print_progress('Completed file:', "'" + file['url'] + "'")
 
-    # Tells ijson to return decimal number as float.  Otherwise, it wraps them in a Decimal object,
-    # which angers the Neo4j driver
-    @staticmethod
-    def ijson_decimal_as_float(events):
-        for prefix, event, value in events:
-            if event == 'number':
-                value = str(value)
-            yield prefix, event, value
-
     def load_json(self, file):
-        with self._driver.session() as session:
-            params = self.get_params(file)
-            openfile = file_handle(params['url'], params['compression'])
-            # 'item' is a magic word in ijson.  It just means the next-level element of an array
-            items = ijson.common.items(self.ijson_decimal_as_float(ijson.parse(openfile)), 'item')
-            # Next, pool these into array of 'chunksize'
-            halt = False
-            rec_num = 0
-            chunk_num = 0
-            rows = []
-            while not halt:
-                row = next(items, None)
-                if row is None:
-                    halt = True
-                else:
-                    rec_num = rec_num+1
-                    if rec_num > params['skip_records']:
-                        rows.append(row)
-                        if len(rows) == params['chunk_size']:
-                            print(file['url'], chunk_num, datetime.datetime.utcnow(), flush=True)
-                            chunk_num = chunk_num + 1
-                            rows_dict = {'rows': rows}
-                            session.run(params['cql'], dict=rows_dict).consume()
-                            rows = []
-
-            if len(rows) > 0:
-                print(file['url'], chunk_num, datetime.datetime.utcnow(), flush=True)
-                rows_dict = {'rows': rows}
-                session.run(params['cql'], dict=rows_dict).consume()
+        params = self.get_params(file)
+        if params['json_engine'] == 'orjson' and orjson is None:
+            print("Error! Can't process file because json_engine orjson was specified but orjson is not installed")
+            return
+        use_orjson = params['json_engine'] == 'orjson'
+        if use_orjson:
+            size = decompressed_size(params['url'], params['compression'])
+            if size is not None and size > params['json_max_bytes']:
+                print_progress('File too large for orjson, streaming with ijson:', "'" + file['url'] + "'")
+                use_orjson = False
+
+        # JSON numbers reach Neo4j as int/float properties with either engine.  Older versions of
+        # this loader stringified every number, and the CSV path still yields only strings, so
+        # MERGE keys on numeric-looking ids won't match values stored as strings by those loads
+        openfile = file_handle(params['url'], params['compression'])
+        if use_orjson:
+            # Parsing the whole document in one C call is much faster than ijson's event stream
+            # when the file fits in memory
+            data = orjson.loads(openfile.read())
+            if not isinstance(data, list):
+                print("Error! Can't process file with orjson because the top level of the document is not an array")
+                return
+            items = iter(data)
+        else:
+            # 'item' is a magic word in ijson.  It just means the next-level element of an array.
+            # use_float makes the parser return floats instead of Decimal objects, which anger the
+            # Neo4j driver (integers stay int)
+            items = ijson.items(openfile, 'item', use_float=True)
+        items = itertools.islice(items, params['skip_records'], None)
+        # Next, pool these into array of 'chunksize'
+        pending = deque()
+        chunk_num = 0
+        next_print = time.monotonic() + progress_interval
+        while True:
+            rows = list(itertools.islice(items, params['chunk_size']))
+            if not rows:
+                break
+            next_print = print_chunk_progress(file['url'], chunk_num, next_print)
+            chunk_num = chunk_num + 1
+            self._submit_chunk(pending, params, rows)
+        self._wait_chunks(pending)
+        print(file['url'], chunk_num, time.time_ns(), flush=True)
 
         # print("{} : Completed file", datetime.datetime.utcnow())
 
+    # Optional 'driver' block of the config, passed straight through to GraphDatabase.driver.
+    # Defaults: max_connection_pool_size = 2 * chunk_workers, fetch_size = 1000.  The
+    # timeouts and max_connection_lifetime (all in seconds) fall back to the driver's own defaults
+    def get_driver_params(self):
+        driver = config.get('driver') or dict()
+        params = dict()
+        params['max_connection_pool_size'] = driver.get('max_connection_pool_size') or 2 * self._workers
+        params['fetch_size'] = driver.get('fetch_size') or 1000
+        for key in driver_timeout_params:
+            if driver.get(key) is not None:
+                params[key] = driver[key]
+        return params
+
     def get_params(self, file):
         params = dict()
         params['skip_records'] = file.get('skip_records') or 0
@@ -105,39 +203,99 @@ class LocalServer(object):
 
         params['url'] = file['url']
         # print("File", params['url'])
-        params['cql'] = file['cql']
+        # Every chunk of the file reuses this one string object, so the statement text is
+        # identical for the server's query plan cache
+        params['cql'] = sys.intern(file['cql'].strip())
+        # Each chunk is sent as the $rows list parameter, and is only fast when the statement
+        # unwinds it: UNWIND $rows AS row MERGE (...)
+        if 'UNWIND' not in params['cql'].upper():
+            warnings.warn("cql for {} does not UNWIND the chunk; per-row Cypher is ~50x slower, "
+                          "use UNWIND $rows AS row".format(params['url']))
+        if '$dict' in params['cql']:
+            warnings.warn("cql for {} uses $dict.rows, which is no longer passed; use $rows".format(params['url']))
+        # apoc.periodic.iterate hands each batch the whole chunk, so the action must not unwind it again
+        params['apoc_parallel'] = bool(file.get('apoc_parallel'))
+        unwind = unwind_rows.match(params['cql'])
+        if params['apoc_parallel'] and (unwind is None or '$rows' in params['cql'][unwind.end():]):
+            print("Error! Ignoring apoc_parallel for {} because its cql doesn't start with "
+                  "'UNWIND $rows AS row' or uses $rows again after it".format(params['url']))
+            params['apoc_parallel'] = False
         params['chunk_size'] = file.get('chunk_size') or 1000
+        if params['apoc_parallel']:
+            # The server only parallelises across inner batches, so each chunk should hold many of them
+            batch_size = file.get('apoc_batch_size') or 1000
+            params['chunk_size'] = file.get('chunk_size') or apoc_batches_per_chunk * batch_size
+            if params['chunk_size'] <= batch_size:
+                warnings.warn("chunk_size for {} is not larger than apoc_batch_size, so apoc_parallel runs "
+                              "a single batch per chunk and can't parallelise".format(params['url']))
+            params['cql'] = sys.intern(apoc_parallel_cql(params['cql'], batch_size))
         params['field_sep'] = file.get('field_separator') or ','
+        params['json_engine'] = file.get('json_engine') or 'ijson'
+        if params['json_engine'] not in supported_json_engines:
+            print("Unsupported JSON engine: {}".format(params['json_engine']))
+        # orjson loads the whole document, so larger files fall back to streaming with ijson
+        params['json_max_bytes'] = file.get('json_max_bytes') or 1 << 30
+        params['csv_engine'] = file.get('csv_engine') or 'pandas'
+        if params['csv_engine'] not in supported_csv_engines:
+            print("Unsupported CSV engine: {}".format(params['csv_engine']))
         return params
 
     def load_csv(self, file):
-        with self._driver.session() as session:
-            params = self.get_params(file)
-
-            openfile = file_handle(params['url'], params['compression'])
+        params = self.get_params(file)
+        if params['csv_engine'] == 'pyarrow' and pa is None:
+            print("Error! Can't process file because csv_engine pyarrow was specified but pyarrow is not installed")
+            return
 
-            # - The file interfaces should be consistent in Python but they aren't
-            if params['compression'] == 'zip':
-                header = openfile.readline().decode('UTF-8')
-            else:
-                header = str(openfile.readline())
+        openfile = file_handle(params['url'], params['compression'])
 
-            # Grab the header from the file and pass that to pandas.  This allow the header
-            # to be applied even if we are skipping lines of the file
-            header = header.strip().split(params['field_sep'])
+        pending = deque()
+        chunk_num = 0
+        next_print = time.monotonic() + progress_interval
+        if params['csv_engine'] == 'pyarrow':
+            # Grab the header from the file so every column can be typed as a string up front.
+            # skip_rows then only counts data rows
+            raw = openfile.readline()
+            header = (raw.decode('utf-8') if isinstance(raw, bytes) else raw).strip().split(params['field_sep'])
+            # Arrow's streaming reader is single threaded, but parses whole blocks in C++ instead
+            # of chunk_size rows at a time.  Every column is read as a string, with pandas' NA
+            # tokens read as nulls, which chunk_records blanks to "" just like the pandas path
+            reader = pa_csv.open_csv(openfile,
+                                     read_options=pa_csv.ReadOptions(column_names=header,
+                                                                     skip_rows=params['skip_records'],
+                                                                     block_size=csv_block_size),
+                                     parse_options=pa_csv.ParseOptions(delimiter=params['field_sep'],
+                                                                       invalid_row_handler=lambda row: 'skip'),
+                                     convert_options=pa_csv.ConvertOptions(
+                                         column_types={column: pa.string() for column in header},
+                                         null_values=csv_null_values, strings_can_be_null=True))
+            for batch in reader:
+                # Blocks are sized in bytes, so re-slice them to keep transactions at chunk_size
+                for offset in range(0, batch.num_rows, params['chunk_size']):
+                    next_print = print_chunk_progress(file['url'], chunk_num, next_print)
+                    chunk_num = chunk_num + 1
+                    self._submit_chunk(pending, params, batch.slice(offset, params['chunk_size']))
+            self._wait_chunks(pending)
+            print(file['url'], chunk_num, time.time_ns(), flush=True)
+            return
 
-            # Pandas' read_csv method is highly optimized and fast :-)
-            row_chunks = pd.read_csv(openfile, dtype=str, sep=params['field_sep'], error_bad_lines=False,
-                                     index_col=False, skiprows=params['skip_records'], names=header,
-                                     low_memory=False, engine='c', compression='infer', header=None,
-                                     chunksize=params['chunk_size'])
+        # Pandas' read_csv method is highly optimized and fast :-)
+        # file_handle has already decompressed the stream, so hand pandas plain text and don't let
+        # it sniff for compression again.  header=0 lets pandas take the column names from the first
+        # line, and skipping range(1, n + 1) drops the first n data rows after it
+        openfile = io.TextIOWrapper(openfile, encoding='utf-8')
+        skiprows = range(1, params['skip_records'] + 1) if params['skip_records'] else None
+        row_chunks = pd.read_csv(openfile, dtype=str, sep=params['field_sep'], error_bad_lines=False,
+                                 index_col=False, skiprows=skiprows, header=0,
+                                 low_memory=False, engine='c', compression=None,
+                                 chunksize=params['chunk_size'])
 
-            for i, rows in enumerate(row_chunks):
-                # print(params['url'], i, datetime.datetime.utcnow(), flush=True)
-                # Chunk up the rows to enable additional fastness :-)
-                rows_dict = {'rows': rows.fillna(value="").to_dict('records')}
-                session.run(params['cql'],
-                            dict=rows_dict).consume()
+        for rows in row_chunks:
+            next_print = print_chunk_progress(file['url'], chunk_num, next_print)
+            chunk_num = chunk_num + 1
+            # Chunk up the rows to enable additional fastness :-)
+            self._submit_chunk(pending, params, rows)
+        self._wait_chunks(pending)
+        print(file['url'], chunk_num, time.time_ns(), flush=True)
 
     def pre_ingest(self):
         if 'pre_ingest' in config:
@@ -159,33 +317,158 @@ class LocalServer(object):
                     session.run(statement)
             print_progress('Finished post-ingest', '')
 
+# Wraps a chunk statement in apoc.periodic.iterate, so the server splits the chunk into batches and
+# merges them on its own worker threads.  Needs APOC with dbms.security.procedures.unrestricted=apoc.*
+def apoc_parallel_cql(cql, batch_size):
+    action = cql[unwind_rows.match(cql).end():]
+    return ("CALL apoc.periodic.iterate('UNWIND $rows AS row RETURN row', {}, "
+            "{{batchSize:{}, parallel:true, params:{{rows:$rows}}}})".format(repr(action), batch_size))
+
+def chunk_records(chunk):
+    if isinstance(chunk, pd.DataFrame):
+        # Every column is a str/NaN object column, so blank out the NaNs in place and build
+        # the records from plain lists rather than going through fillna().to_dict()
+        columns = chunk.columns.tolist()
+        arr = chunk.to_numpy(dtype=object, copy=False)
+        arr[pd.isna(arr)] = ""
+        return [dict(zip(columns, row)) for row in arr.tolist()]
+    elif pa is not None and isinstance(chunk, pa.RecordBatch):
+        columns = [pa_compute.fill_null(column, "") for column in chunk.columns]
+        return pa.RecordBatch.from_arrays(columns, names=chunk.schema.names).to_pylist()
+    return chunk
+
+def do_write(tx, cql, rows):
+    return tx.run(cql, rows=rows).consume()
+
+# apoc.periodic.iterate commits its inner batches itself and reports failures in its result row
+# instead of raising.  It runs as an auto-commit statement, because a managed retry would re-run
+# batches that already committed
+def do_apoc_write(session, cql, rows):
+    record = session.run(cql, rows=rows).single()
+    if record['failedBatches'] > 0:
+        raise RuntimeError("apoc.periodic.iterate failed {} of {} batches ({} operations): {}".format(
+            record['failedBatches'], record['batches'], record['failedOperations'], record['errorMessages']))
+
+# Every handle is a binary stream.  S3 objects are streamed through smart_open with a large
+# read buffer rather than being pulled into memory, and the (decompressed) stream is read ahead
+# on a background thread so that I/O overlaps with parsing
 def file_handle(url, compression):
-    parsed = urlparse(url)
-    if parsed.scheme == 's3':
-        path = get_s3_client().get_object(Bucket=parsed.netloc, Key=parsed.path[1:])['Body']
-    elif parsed.scheme == 'file':
-        path = parsed.path
-    else:
-        path = url
-    if compression == 'gzip':
-        return gzip.open(path, 'rt')
-    elif compression == 'zip':
-        # Only support single file in ZIP archive for now
-        if isinstance(path, str):
-            buffer = path
-        else:
-            buffer = io.BytesIO(path.read())
-        zf = ZipFile(buffer)
+    if compression == 'zip':
+        # Only support single file in ZIP archive for now.  smart_open handles (S3 included) are
+        # seekable, so ZipFile can find the central directory and stream the entry from there
+        zf = ZipFile(open_binary(url))
         filename = zf.infolist()[0].filename
-        return zf.open(filename)
+        handle = zf.open(filename)
+    elif compression == 'gzip':
+        handle = gzip.open(open_binary(url))
     else:
-        return open(path)
+        handle = open_binary(url)
+    return io.BufferedReader(PrefetchReader(handle, block=prefetch_block_size))
+
+def open_binary(url):
+    transport_params = {'buffer_size': read_buffer_size}
+    if urlparse(url).scheme == 's3':
+        transport_params['client'] = get_s3_client()
+    return open(url, 'rb', compression='disable', transport_params=transport_params)
+
+# Size in bytes of the stored (possibly still compressed) object, or None if it can't be cheaply found
+def object_size(url):
+    parsed = urlparse(url)
+    if parsed.scheme == 's3':
+        return get_s3_client().head_object(Bucket=parsed.netloc, Key=parsed.path[1:])['ContentLength']
+    elif parsed.scheme in ('', 'file'):
+        return os.path.getsize(parsed.path)
+    return None
+
+# Estimated size in bytes of the decompressed document, or None if it can't be cheaply found.  gzip
+# doesn't record a usable size for large files, so assume a generous compression ratio instead
+def decompressed_size(url, compression):
+    if compression == 'zip':
+        with open_binary(url) as handle:
+            return ZipFile(handle).infolist()[0].file_size
+    size = object_size(url)
+    if size is not None and compression == 'gzip':
+        return size * gzip_size_ratio
+    return size
+
+# One client (and connection pool) shared by every file and thread; boto3 clients are thread safe
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    return boto3.Session().client('s3', config=botocore.config.Config(max_pool_connections=64,
+                                                                      retries={'mode': 'adaptive'}))
+
+# Double-buffering reader: a background thread keeps reading blocks from the underlying stream
+# into a small queue while the parser consumes the previous ones
+class PrefetchReader(io.RawIOBase):
+
+    def __init__(self, raw, block, depth=4):
+        self._raw = raw
+        self.block = block
+        self._q = queue.Queue(maxsize=depth)
+        self._leftover = memoryview(b'')
+        self._eof = False
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._raw.read(self.block)
+                if not chunk:
+                    break
+                self._put(chunk)
+        except Exception as e:
+            self._error = e
+        self._put(None)
+
+    # Don't block forever on a full queue if the reader was closed before reaching EOF
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._leftover:
+            if self._eof:
+                return 0
+            chunk = self._q.get()
+            if chunk is None:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                return 0
+            self._leftover = memoryview(chunk)
+        n = min(len(b), len(self._leftover))
+        b[:n] = self._leftover[:n]
+        self._leftover = self._leftover[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._raw.close()
+        super().close()
 
 def print_progress(msg, value=''):
     print("{:%Y-%m-%d %H:%M:%S}\t{}\t{}".format(datetime.datetime.now(), msg, value))
 
-def get_s3_client():
-    return boto3.Session().client('s3')
+# Per-chunk progress, printed at most once every progress_interval seconds so fast small chunks
+# don't pay for a timestamp and a flushed write each.  Returns the next time a line is due
+def print_chunk_progress(url, chunk_num, next_print):
+    now = time.monotonic()
+    if now < next_print:
+        return next_print
+    print(url, chunk_num, time.time_ns(), flush=True)
+    return now + progress_interval
 
 
 def load_config(configuration):
@@ -203,7 +486,10 @@ def main():
     for file in file_list:
         if 'basepath' in config:
             file['url'] = config['basepath'] + file['url']
-        server.load_file(file)
+    # Files are loaded one at a time, in the listed order, unless file_workers > 1.  Files loaded
+    # together must not depend on each other (e.g. relationships that MATCH nodes from another file)
+    with ThreadPoolExecutor(max_workers=config.get('file_workers') or 1) as executor:
+        list(executor.map(server.load_file, file_list))
 
     server.post_ingest()
     server.close()